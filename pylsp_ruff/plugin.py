@@ -1,24 +1,45 @@
 import enum
+import hashlib
 import importlib.util
 import json
 import logging
+import os
 import re
 import shutil
 import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import replace
 from functools import lru_cache
 from pathlib import PurePath
 from subprocess import PIPE, Popen
-from typing import Dict, Generator, List, Optional
+from typing import (
+    Any,
+    Dict,
+    Generator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads  # type: ignore
 
-if sys.version_info >= (3, 11):
-    import tomllib
-else:
-    import tomli as tomllib
+try:
+    import msgspec
+except ImportError:
+    msgspec = None  # type: ignore
 
 from lsprotocol.types import (
     CodeAction,
     CodeActionContext,
     CodeActionKind,
+    Command,
     Diagnostic,
     DiagnosticSeverity,
     DiagnosticTag,
@@ -34,21 +55,46 @@ from pylsp.workspace import Document, Workspace
 
 from pylsp_ruff.ruff import Check as RuffCheck
 from pylsp_ruff.ruff import Fix as RuffFix
+from pylsp_ruff.ruff import Location as RuffLocation
 from pylsp_ruff.settings import PluginSettings, get_converter
 
 log = logging.getLogger(__name__)
 logging.getLogger("blib2to3").setLevel(logging.ERROR)
 converter = get_converter()
 
-DIAGNOSTIC_SOURCE = "ruff"
 
-# shamelessly borrowed from:
-# https://github.com/charliermarsh/ruff-lsp/blob/2a0e2ea3afefdbf00810b8df91030c1c6b59d103/ruff_lsp/server.py#L214
-NOQA_REGEX = re.compile(
-    r"(?i:# (?:(?:ruff|flake8): )?(?P<noqa>noqa))"
-    r"(?::\s?(?P<codes>([A-Z]+[0-9]+(?:[,\s]+)?)+))?"
+@lru_cache(maxsize=1024)
+def _intern_location(row: int, column: int) -> RuffLocation:
+    return RuffLocation(row=row, column=column)
+
+
+# Checks and the edits of their fixes mostly point to the same few positions,
+# share one object per position instead of structuring a new one each time.
+converter.register_structure_hook(
+    RuffLocation, lambda obj, _: _intern_location(obj["row"], obj["column"])
 )
 
+# Resolve the (un)structure hooks for the hot paths once instead of dispatching
+# on every call.
+_structure_checks = converter.get_structure_hook(List[RuffCheck])
+_structure_context = converter.get_structure_hook(CodeActionContext)
+_structure_fix = converter.get_structure_hook(RuffFix)
+_structure_diagnostic = converter.get_structure_hook(Diagnostic)
+_unstructure_fix = converter.get_unstructure_hook(RuffFix)
+_unstructure_code_actions = converter.get_unstructure_hook(List[CodeAction])
+_unstructure_text_edits = converter.get_unstructure_hook(List[TextEdit])
+_unstructure_workspace_edit = converter.get_unstructure_hook(WorkspaceEdit)
+
+# msgspec decodes ruff's output straight into the check dataclasses
+_checks_decoder = msgspec.json.Decoder(List[RuffCheck]) if msgspec else None
+
+DIAGNOSTIC_SOURCE = "ruff"
+
+FIX_ALL_COMMAND = "pylsp_ruff.fixAll"
+
+# Optional prefixes of a noqa comment, i.e. `# ruff: noqa` and `# flake8: noqa`
+NOQA_PREFIXES = ("ruff: ", "flake8: ")
+
 
 UNNECESSITY_CODES = {
     "F401",  # `module` imported but unused
@@ -58,6 +104,14 @@ UNNECESSITY_CODES = {
     "F841",  # local variable `name` is assigned to but never used
 }
 
+# Codes reported as errors by default, besides all pyflakes (F) codes
+ERROR_CODES = frozenset(
+    {
+        "None",  # syntax errors without a code
+        "E999",  # syntax error
+    }
+)
+
 DIAGNOSTIC_SEVERITIES = {
     "E": DiagnosticSeverity.Error,
     "W": DiagnosticSeverity.Warning,
@@ -65,6 +119,47 @@ DIAGNOSTIC_SEVERITIES = {
     "H": DiagnosticSeverity.Hint,
 }
 
+# Line breaks as understood by ruff and LSP
+LINE_BREAK_REGEX = re.compile(r"\r\n|\r|\n")
+
+# Key of the encoded source in `Document.shared_data`
+SOURCE_BYTES_KEY = "ruff_source_bytes"
+# Key of the line offsets in `Document.shared_data`
+LINE_OFFSETS_KEY = "ruff_line_offsets"
+# Key of the digest of the encoded source in `Document.shared_data`
+SOURCE_DIGEST_KEY = "ruff_source_digest"
+
+# Linux allows passing the document source to ruff as an in-memory file
+HAS_MEMFD = hasattr(os, "memfd_create")
+
+# Seconds for which the config file lookup of a directory is reused
+FIND_PARENTS_TTL = 2.0
+
+# Number of directories for which the config file lookup is kept
+FIND_PARENTS_CACHE_SIZE = 128
+
+_ParentCacheKey = Tuple[str, str, Tuple[str, ...]]
+_parent_cache: "OrderedDict[_ParentCacheKey, Tuple[List[str], float]]" = OrderedDict()
+
+# Number of diagnostics in a code action request from which ruff is run in the
+# background while their quick fixes are built
+CONCURRENT_CHECK_MIN_DIAGNOSTICS = 8
+
+_check_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pylsp_ruff")
+
+# Number of documents for which the result of the last lint run is kept
+CHECK_CACHE_SIZE = 32
+
+_check_cache: "OrderedDict[str, Tuple[Tuple[bytes, str], List[RuffCheck]]]" = (
+    OrderedDict()
+)
+
+
+class NoqaLine(NamedTuple):
+    line: str
+    has_noqa: bool
+    has_codes: bool
+
 
 class Subcommand(str, enum.Enum):
     CHECK = "check"
@@ -124,8 +219,11 @@ def pylsp_format_document(workspace: Workspace, document: Document) -> Generator
     result = outcome.get_result()
     if result:
         source = result[0]["newText"]
+        document_source: Union[str, bytes] = source
     else:
         source = document.source
+        # Reuse the encoded source of the linting and code actions
+        document_source = encode_source(document)
 
     settings = load_settings(workspace=workspace, document_path=document.path)
     if not settings.format_enabled:
@@ -133,7 +231,9 @@ def pylsp_format_document(workspace: Workspace, document: Document) -> Generator
 
     with workspace.report_progress("format: ruff"):
         new_text = run_ruff_format(
-            settings=settings, document_path=document.path, document_source=source
+            settings=settings,
+            document_path=document.path,
+            document_source=document_source,
         )
 
         if settings.format:
@@ -149,7 +249,7 @@ def pylsp_format_document(workspace: Workspace, document: Document) -> Generator
                 document_path=document.path,
                 document_source=new_text,
                 fix=True,
-            )
+            ).decode()
 
         # Avoid applying empty text edit
         if not new_text or new_text == source:
@@ -157,11 +257,11 @@ def pylsp_format_document(workspace: Workspace, document: Document) -> Generator
 
         range = Range(
             start=Position(line=0, character=0),
-            end=Position(line=len(document.lines), character=0),
+            end=Position(line=get_line_count(document), character=0),
         )
         text_edit = TextEdit(range=range, new_text=new_text)
 
-        outcome.force_result(converter.unstructure([text_edit]))
+        outcome.force_result(_unstructure_text_edits([text_edit]))
 
 
 @hookimpl
@@ -183,8 +283,8 @@ def pylsp_lint(workspace: Workspace, document: Document) -> List[Dict]:
     with workspace.report_progress("lint: ruff"):
         settings = load_settings(workspace, document.path)
         checks = run_ruff_check(document=document, settings=settings)
-        diagnostics = [create_diagnostic(check=c, settings=settings) for c in checks]
-        return converter.unstructure(diagnostics)
+        cache_checks(document=document, settings=settings, checks=checks)
+        return create_diagnostic_dicts(checks=checks, settings=settings)
 
 
 def create_diagnostic(check: RuffCheck, settings: PluginSettings) -> Diagnostic:
@@ -202,51 +302,123 @@ def create_diagnostic(check: RuffCheck, settings: PluginSettings) -> Diagnostic:
     Diagnostic
 
     """
-    # Adapt range to LSP specification (zero-based)
-    range = Range(
-        start=Position(
-            line=check.location.row - 1,
-            character=check.location.column - 1,
-        ),
-        end=Position(
-            line=check.end_location.row - 1,
-            character=check.end_location.column - 1,
-        ),
-    )
+    # Share the conversion logic with the lint diagnostics, but keep the fix as
+    # is instead of unstructuring it, see `get_diagnostic_fix`.
+    diagnostic_dict = create_diagnostic_dicts(
+        checks=[replace(check, fix=None)], settings=settings
+    )[0]
+    diagnostic = _structure_diagnostic(diagnostic_dict, Diagnostic)
+    diagnostic.data = check.fix
+    return diagnostic
+
+
+def create_diagnostic_dicts(
+    checks: List[RuffCheck], settings: PluginSettings
+) -> List[Dict]:
+    """Create unstructured LSP diagnostics based on the given RuffCheck objects.
 
-    # Ruff intends to implement severity codes in the future,
-    # see https://github.com/charliermarsh/ruff/issues/645.
-    severity = DiagnosticSeverity.Warning
-    if check.code == "None" or check.code == "E999" or check.code[0] == "F":
-        severity = DiagnosticSeverity.Error
-
-    # Check if check.code starts contained in given severities
-    if settings.severities is not None:
-        _custom_sev = [
-            sev
-            for pat, sev in sorted(
-                settings.severities.items(), key=lambda key: (len(key), key)
-            )
-            if check.code.startswith(pat)
-        ]
-
-        if _custom_sev:
-            custom_sev = _custom_sev[-1]
-            severity = DIAGNOSTIC_SEVERITIES.get(custom_sev, severity)
-
-    tags = []
-    if check.code in UNNECESSITY_CODES:
-        tags = [DiagnosticTag.Unnecessary]
-
-    return Diagnostic(
-        source=DIAGNOSTIC_SOURCE,
-        code=check.code,
-        range=range,
-        message=check.message,
-        severity=severity,
-        tags=tags,
-        data=check.fix,
-    )
+    The dicts are built directly instead of unstructuring Diagnostic objects,
+    pylsp expects the diagnostics as dicts anyway.
+
+    Parameters
+    ----------
+    checks : List[RuffCheck]
+        RuffCheck objects to convert.
+    settings : PluginSettings
+        Current settings.
+
+    Returns
+    -------
+    List of dicts containing the diagnostics.
+
+    """
+    severity_table = get_severity_table(settings)
+    unnecessity_codes = UNNECESSITY_CODES
+    unnecessary = DiagnosticTag.Unnecessary.value
+    unstructure_fix = _unstructure_fix
+
+    diagnostics = []
+    for check in checks:
+        code = check.code
+        location = check.location
+        end_location = check.end_location
+
+        diagnostic = {
+            # Adapt range to LSP specification (zero-based)
+            "range": {
+                "start": {"line": location.row - 1, "character": location.column - 1},
+                "end": {
+                    "line": end_location.row - 1,
+                    "character": end_location.column - 1,
+                },
+            },
+            "message": check.message,
+            "severity": severity_table[code].value,
+            "code": code,
+            "source": DIAGNOSTIC_SOURCE,
+            "tags": [unnecessary] if code in unnecessity_codes else [],
+        }
+        if check.fix is not None:
+            diagnostic["data"] = unstructure_fix(check.fix)
+        diagnostics.append(diagnostic)
+
+    return diagnostics
+
+
+class SeverityTable(Dict[str, DiagnosticSeverity]):
+    """Maps codes to their diagnostic severity, resolved on the first lookup.
+
+    Parameters
+    ----------
+    severities : Dict[str, str]
+        Custom severities given by code patterns.
+
+    """
+
+    def __init__(self, severities: Dict[str, str]):
+        super().__init__()
+        self.custom_severities = sorted(
+            severities.items(), key=lambda key: (len(key), key)
+        )
+
+    def __missing__(self, code: str) -> DiagnosticSeverity:
+        # Ruff intends to implement severity codes in the future,
+        # see https://github.com/charliermarsh/ruff/issues/645.
+        severity = DiagnosticSeverity.Warning
+        if code in ERROR_CODES or code[:1] == "F":
+            severity = DiagnosticSeverity.Error
+
+        # Check if code starts contained in given severities, the last match wins
+        custom_severity = None
+        for pat, sev in self.custom_severities:
+            if code.startswith(pat):
+                custom_severity = sev
+        if custom_severity is not None:
+            severity = DIAGNOSTIC_SEVERITIES.get(custom_severity, severity)
+
+        self[code] = severity
+        return severity
+
+
+def get_severity_table(settings: PluginSettings) -> SeverityTable:
+    """Return the severity table for the custom severities of the settings.
+
+    Parameters
+    ----------
+    settings : PluginSettings
+        Current settings.
+
+    Returns
+    -------
+    SeverityTable
+
+    """
+    return _get_severity_table(tuple(sorted((settings.severities or {}).items())))
+
+
+@lru_cache(maxsize=32)
+def _get_severity_table(severities: Tuple[Tuple[str, str], ...]) -> SeverityTable:
+    return SeverityTable(dict(severities))
 
 
 @hookimpl
@@ -279,64 +451,167 @@ def pylsp_code_actions(
     """
     log.debug(f"textDocument/codeAction: {document} {range} {context}")
 
-    _context = converter.structure(context, CodeActionContext)
-    diagnostics = _context.diagnostics
+    _context = _structure_context(context, CodeActionContext)
+
+    # Only compute the kinds of code actions the client asked for
+    want_quickfix = is_kind_requested(_context.only, CodeActionKind.QuickFix)
+    want_organize_imports = is_kind_requested(
+        _context.only, CodeActionKind.SourceOrganizeImports
+    )
+    want_fix_all = is_kind_requested(_context.only, CodeActionKind.SourceFixAll)
+    if not (want_quickfix or want_organize_imports or want_fix_all):
+        return []
 
     code_actions = []
-    has_organize_imports = False
+    # Several diagnostics often point to the same line, only inspect it once
+    noqa_lines: Dict[int, NoqaLine] = {}
 
     settings = load_settings(workspace=workspace, document_path=document.path)
 
-    for diagnostic in diagnostics:
+    # Quick fixes are built from the diagnostics given in the context
+    diagnostics = _context.diagnostics if want_quickfix else []
+    fixes = [get_diagnostic_fix(diagnostic) for diagnostic in diagnostics]
+
+    # Ruff only needs to check the whole document if the context diagnostics
+    # do not already provide the organize imports and Fix All actions
+    has_organize_imports = want_organize_imports and any(
+        diagnostic.code == "I001"
+        and fix is not None
+        and (fix.applicability != "unsafe" or settings.unsafe_fixes)
+        for diagnostic, fix in zip(diagnostics, fixes)
+    )
+    has_safe_fix = any(fix is not None and fix.applicability == "safe" for fix in fixes)
+    needs_checks = (want_organize_imports and not has_organize_imports) or (
+        want_fix_all and not has_safe_fix
+    )
+
+    # The editor usually requests code actions right after the document was
+    # linted, reuse that result if the document did not change in between.
+    # Otherwise start ruff early and build the quick fixes while it runs.
+    checks: Optional[List[RuffCheck]] = None
+    checks_future: "Optional[Future[List[RuffCheck]]]" = None
+    if needs_checks:
+        checks = get_cached_checks(document=document, settings=settings)
+        if checks is None and len(diagnostics) >= CONCURRENT_CHECK_MIN_DIAGNOSTICS:
+            checks_future = _check_executor.submit(
+                run_ruff_check, document=document, settings=settings
+            )
+
+    for diagnostic, fix in zip(diagnostics, fixes):
         code_actions.append(
-            create_disable_code_action(document=document, diagnostic=diagnostic)
+            create_disable_code_action(
+                document=document, diagnostic=diagnostic, noqa_lines=noqa_lines
+            )
         )
 
-        if diagnostic.data:  # Has fix
-            fix = converter.structure(diagnostic.data, RuffFix)
+        if fix is None:
+            continue
 
-            if fix.applicability == "unsafe":
-                if not settings.unsafe_fixes:
-                    continue
-                fix.message += " (unsafe)"
+        if fix.applicability == "unsafe":
+            if not settings.unsafe_fixes:
+                continue
+            fix = replace(fix, message=f"{fix.message} (unsafe)")
 
-            if diagnostic.code == "I001":
+        if diagnostic.code == "I001":
+            if want_organize_imports:
                 code_actions.append(
                     create_organize_imports_code_action(
                         document=document, diagnostic=diagnostic, fix=fix
                     )
                 )
-                has_organize_imports = True
-            else:
+        else:
+            code_actions.append(
+                create_fix_code_action(
+                    document=document, diagnostic=diagnostic, fix=fix
+                ),
+            )
+
+    if needs_checks:
+        if checks_future is not None:
+            checks = checks_future.result()
+        elif checks is None:
+            checks = run_ruff_check(document=document, settings=settings)
+        checks_with_fixes = [c for c in checks if c.fix]
+        checks_organize_imports = [c for c in checks_with_fixes if c.code == "I001"]
+
+        if (
+            want_organize_imports
+            and not has_organize_imports
+            and checks_organize_imports
+        ):
+            check = checks_organize_imports[0]
+            diagnostic = create_diagnostic(check=check, settings=settings)
+            code_actions.append(
+                create_organize_imports_code_action(
+                    document=document,
+                    diagnostic=diagnostic,
+                    fix=check.fix,  # type: ignore
+                ),
+            )
+            if want_quickfix:
                 code_actions.append(
-                    create_fix_code_action(
-                        document=document, diagnostic=diagnostic, fix=fix
+                    create_disable_code_action(
+                        document=document, diagnostic=diagnostic, noqa_lines=noqa_lines
                     ),
                 )
 
-    checks = run_ruff_check(document=document, settings=settings)
-    checks_with_fixes = [c for c in checks if c.fix]
-    checks_organize_imports = [c for c in checks_with_fixes if c.code == "I001"]
-
-    if not has_organize_imports and checks_organize_imports:
-        check = checks_organize_imports[0]
-        fix = check.fix  # type: ignore
-        diagnostic = create_diagnostic(check=check, settings=settings)
-        code_actions.extend(
-            [
-                create_organize_imports_code_action(
-                    document=document, diagnostic=diagnostic, fix=fix
-                ),
-                create_disable_code_action(document=document, diagnostic=diagnostic),
-            ]
-        )
+        if not has_safe_fix:
+            has_safe_fix = any(
+                [c.fix.applicability == "safe" for c in checks_with_fixes]  # type: ignore
+            )
 
-    if any([c.fix.applicability == "safe" for c in checks_with_fixes]):  # type: ignore
+    if want_fix_all and has_safe_fix:
         code_actions.append(
             create_fix_all_code_action(document=document, settings=settings),
         )
 
-    return converter.unstructure(code_actions)
+    return _unstructure_code_actions(code_actions)
+
+
+def get_diagnostic_fix(diagnostic: Diagnostic) -> Optional[RuffFix]:
+    """Return the ruff fix attached to the data of a diagnostic.
+
+    Parameters
+    ----------
+    diagnostic : Diagnostic
+        Diagnostic created by `pylsp_lint`.
+
+    Returns
+    -------
+    RuffFix or None if the diagnostic has no fix.
+
+    """
+    if not diagnostic.data:
+        return None
+    if isinstance(diagnostic.data, RuffFix):
+        return diagnostic.data
+    return _structure_fix(diagnostic.data, RuffFix)
+
+
+def is_kind_requested(
+    only: Optional[List[CodeActionKind]], kind: CodeActionKind
+) -> bool:
+    """Check whether code actions of the given kind were requested.
+
+    Parameters
+    ----------
+    only : Optional[List[CodeActionKind]]
+        Kinds requested through `CodeActionContext.only`, all kinds if not set.
+    kind : CodeActionKind
+        Kind of the code action to check.
+
+    Returns
+    -------
+    True if the kind or one of its parent kinds was requested.
+
+    """
+    if not only:
+        return True
+    # Kinds are hierarchical, e.g. `source` includes `source.fixAll`
+    return any(
+        not requested or kind == requested or kind.startswith(f"{requested}.")
+        for requested in only
+    )
 
 
 def create_fix_code_action(
@@ -357,17 +632,161 @@ def create_fix_code_action(
     )
 
 
+def get_line(document: Document, line_number: int) -> str:
+    """Return a single line of the document.
+
+    Unlike `document.lines` this does not split the whole source on every call,
+    the line offsets are computed once per source and kept on the document.
+
+    Parameters
+    ----------
+    document : pylsp.workspace.Document
+        Document containing the line.
+    line_number : int
+        Zero-based number of the line.
+
+    Returns
+    -------
+    The line including its line break.
+
+    """
+    source, offsets = get_line_offsets(document)
+    start = offsets[line_number]
+    if line_number + 1 < len(offsets):
+        return source[start : offsets[line_number + 1]]
+    return source[start:]
+
+
+def get_line_count(document: Document) -> int:
+    """Return the number of lines of the document.
+
+    Used for text edits replacing the whole document in place of
+    `len(document.lines)`, without splitting the source.
+
+    Parameters
+    ----------
+    document : pylsp.workspace.Document
+        Document to count the lines of.
+
+    Returns
+    -------
+    The number of lines.
+
+    """
+    source, offsets = get_line_offsets(document)
+    if not source:
+        return 0
+    return len(offsets)
+
+
+def get_line_offsets(document: Document) -> Tuple[str, List[int]]:
+    """Return the source of the document and the offsets its lines start at.
+
+    Parameters
+    ----------
+    document : pylsp.workspace.Document
+        Document to index.
+
+    Returns
+    -------
+    Tuple of the source and the list of line offsets.
+
+    """
+    source = document.source
+    cached = document.shared_data.get(LINE_OFFSETS_KEY)
+    if cached is not None and cached[0] is source:
+        return cached
+
+    offsets = [0]
+    offsets.extend(match.end() for match in LINE_BREAK_REGEX.finditer(source))
+    # A trailing line break does not start another line
+    if len(offsets) > 1 and offsets[-1] == len(source):
+        offsets.pop()
+
+    document.shared_data[LINE_OFFSETS_KEY] = (source, offsets)
+    return source, offsets
+
+
+def get_noqa_line(document: Document, line_number: int) -> NoqaLine:
+    """Inspect the noqa comment of the given line.
+
+    Parameters
+    ----------
+    document : pylsp.workspace.Document
+        Document containing the line.
+    line_number : int
+        Zero-based number of the line.
+
+    Returns
+    -------
+    NoqaLine
+
+    """
+    line = get_line(document, line_number).rstrip("\r\n")
+    has_noqa, has_codes = find_noqa(line)
+    return NoqaLine(line=line, has_noqa=has_noqa, has_codes=has_codes)
+
+
+def find_noqa(line: str) -> Tuple[bool, bool]:
+    """Find the first noqa comment in the line.
+
+    Matches the same comments as the regex used by ruff-lsp
+    (https://github.com/charliermarsh/ruff-lsp/blob/2a0e2ea3afefdbf00810b8df91030c1c6b59d103/ruff_lsp/server.py#L214),
+    but scans for the `#` with `str.find` instead of running a regex.
+
+    Parameters
+    ----------
+    line : str
+        The line to search.
+
+    Returns
+    -------
+    Tuple of whether the line has a noqa comment and whether the comment lists
+    codes, e.g. `# noqa: E501`.
+
+    """
+    start = line.find("# ")
+    while start != -1:
+        position = start + 2
+        for prefix in NOQA_PREFIXES:
+            if line[position : position + len(prefix)].lower() == prefix:
+                position += len(prefix)
+                break
+        if line[position : position + 4].lower() == "noqa":
+            return True, _has_noqa_codes(line, position + 4)
+        start = line.find("# ", start + 1)
+    return False, False
+
+
+def _has_noqa_codes(line: str, position: int) -> bool:
+    # `: ` or `:` followed by a code, i.e. upper case letters and digits
+    if line[position : position + 1] != ":":
+        return False
+    position += 1
+    if line[position : position + 1].isspace():
+        position += 1
+    end = position
+    while "A" <= line[end : end + 1] <= "Z":
+        end += 1
+    return end > position and "0" <= line[end : end + 1] <= "9"
+
+
 def create_disable_code_action(
     document: Document,
     diagnostic: Diagnostic,
+    noqa_lines: Optional[Dict[int, NoqaLine]] = None,
 ) -> CodeAction:
     title = f"Ruff ({diagnostic.code}): Disable for this line"
     kind = CodeActionKind.QuickFix
 
-    line = document.lines[diagnostic.range.start.line].rstrip("\r\n")
-    match = NOQA_REGEX.search(line)
-    has_noqa = match is not None
-    has_codes = match and match.group("codes") is not None
+    line_number = diagnostic.range.start.line
+    if noqa_lines is None:
+        noqa_lines = {}
+    noqa_line = noqa_lines.get(line_number)
+    if noqa_line is None:
+        noqa_line = noqa_lines[line_number] = get_noqa_line(document, line_number)
+    line, has_noqa, has_codes = noqa_line
+
     # `foo  # noqa: OLD` -> `foo  # noqa: OLD,NEW`
     if has_noqa and has_codes:
         new_line = f"{line},{diagnostic.code}"
@@ -379,8 +798,8 @@ def create_disable_code_action(
         new_line = f"{line}  # noqa: {diagnostic.code}"
 
     range = Range(
-        start=Position(line=diagnostic.range.start.line, character=0),
-        end=Position(line=diagnostic.range.start.line, character=len(line)),
+        start=Position(line=line_number, character=0),
+        end=Position(line=line_number, character=len(line)),
     )
     text_edit = TextEdit(range=range, new_text=new_line)
     workspace_edit = WorkspaceEdit(changes={document.uri: [text_edit]})
@@ -417,35 +836,89 @@ def create_fix_all_code_action(
     title = "Ruff: Fix All (safe fixes)"
     kind = CodeActionKind.SourceFixAll
 
+    if not settings.lazy_fix_all:
+        return CodeAction(
+            title=title,
+            kind=kind,
+            edit=create_fix_all_edit(document=document, settings=settings),
+        )
+
+    # Running the fixes is deferred until the action is executed, see
+    # `pylsp_execute_command`. The version guards against applying fixes
+    # computed from a different state of the document.
+    command = Command(
+        title=title,
+        command=FIX_ALL_COMMAND,
+        arguments=[document.uri, document.version],
+    )
+    return CodeAction(
+        title=title,
+        kind=kind,
+        command=command,
+    )
+
+
+def create_fix_all_edit(document: Document, settings: PluginSettings) -> WorkspaceEdit:
     # No unsafe fixes for 'Fix all', see https://github.com/python-lsp/python-lsp-ruff/issues/55
-    settings.unsafe_fixes = False
+    settings = replace(settings, unsafe_fixes=False)
 
     new_text = run_ruff_fix(document=document, settings=settings)
     range = Range(
         start=Position(line=0, character=0),
-        end=Position(line=len(document.lines), character=0),
+        end=Position(line=get_line_count(document), character=0),
     )
     text_edit = TextEdit(range=range, new_text=new_text)
-    workspace_edit = WorkspaceEdit(changes={document.uri: [text_edit]})
-    return CodeAction(
-        title=title,
-        kind=kind,
-        edit=workspace_edit,
-    )
+    return WorkspaceEdit(changes={document.uri: [text_edit]})
+
+
+@hookimpl
+def pylsp_commands() -> List[str]:
+    return [FIX_ALL_COMMAND]
+
+
+@hookimpl
+def pylsp_execute_command(
+    workspace: Workspace, command: str, arguments: List[Any]
+) -> None:
+    """Apply the fixes of the 'Fix All' code action.
+
+    Parameters
+    ----------
+    workspace : pylsp.workspace.Workspace
+        Current workspace.
+    command : str
+        Command to execute, other commands than `FIX_ALL_COMMAND` are ignored.
+    arguments : List[Any]
+        Arguments of the command, the uri and the version of the document to fix.
+
+    """
+    if command != FIX_ALL_COMMAND:
+        return
+
+    uri, version = arguments
+    document = workspace.get_document(uri)
+    # pylsp always passes the default workspace, a document of another workspace
+    # folder is read from disk then and has no version.
+    if document.version is None or document.version != version:
+        log.warning(
+            f"Not applying 'Fix All' to {uri}, version {document.version} "
+            f"does not match the requested version {version}"
+        )
+        return
+
+    settings = load_settings(workspace=workspace, document_path=document.path)
+    workspace_edit = create_fix_all_edit(document=document, settings=settings)
+    workspace.apply_edit(_unstructure_workspace_edit(workspace_edit))
 
 
 def create_text_edits(fix: RuffFix) -> List[TextEdit]:
     edits = []
     for edit in fix.edits:
+        location = edit.location
+        end_location = edit.end_location
         range = Range(
-            start=Position(
-                line=edit.location.row - 1,
-                character=edit.location.column - 1,
-            ),
-            end=Position(
-                line=edit.end_location.row - 1,
-                character=edit.end_location.column - 1,
-            ),
+            start=Position(line=location.row - 1, character=location.column - 1),
+            end=Position(line=end_location.row - 1, character=end_location.column - 1),
         )
         edits.append(TextEdit(range=range, new_text=edit.content))
     return edits
@@ -454,38 +927,146 @@ def create_text_edits(fix: RuffFix) -> List[TextEdit]:
 def run_ruff_check(document: Document, settings: PluginSettings) -> List[RuffCheck]:
     result = run_ruff(
         document_path=document.path,
-        document_source=document.source,
+        document_source=encode_source(document),
         settings=settings,
         subcommand=Subcommand.CHECK,
     )
+    if _checks_decoder is not None:
+        try:
+            return _checks_decoder.decode(result)
+        except msgspec.DecodeError:
+            # e.g. syntax errors come without a code, let cattrs handle those
+            pass
     try:
-        result = json.loads(result)
-    except json.JSONDecodeError:
+        result = json_loads(result)
+    except ValueError:
         result = []  # type: ignore
-    return converter.structure(result, List[RuffCheck])
+    return _structure_checks(result, List[RuffCheck])
+
+
+def _check_cache_key(document: Document, settings: PluginSettings) -> Tuple[bytes, str]:
+    # Key on the content instead of the version, documents that are not open in
+    # the editor have no version.
+    return (source_digest(document), repr(settings))
+
+
+def cache_checks(
+    document: Document, settings: PluginSettings, checks: List[RuffCheck]
+) -> None:
+    """Remember the checks of the given document for the code actions.
+
+    Parameters
+    ----------
+    document : pylsp.workspace.Document
+        Document the checks were created for.
+    settings : PluginSettings
+        Settings used to create the checks.
+    checks : List[RuffCheck]
+        Result of `run_ruff_check`.
+
+    """
+    _check_cache[document.uri] = (_check_cache_key(document, settings), checks)
+    _check_cache.move_to_end(document.uri)
+    while len(_check_cache) > CHECK_CACHE_SIZE:
+        _check_cache.popitem(last=False)
+
+
+def get_cached_checks(
+    document: Document, settings: PluginSettings
+) -> Optional[List[RuffCheck]]:
+    """Return the cached checks of the document if it is unchanged.
+
+    Parameters
+    ----------
+    document : pylsp.workspace.Document
+        Document to get the checks for.
+    settings : PluginSettings
+        Settings the checks have to be created with.
+
+    Returns
+    -------
+    List of RuffCheck objects or None if nothing matching is cached.
+
+    """
+    cached = _check_cache.get(document.uri)
+    if cached is None or cached[0] != _check_cache_key(document, settings):
+        return None
+    return cached[1]
+
+
+def encode_source(document: Document) -> bytes:
+    """Return the utf-8 encoded source of the document.
+
+    The encoded source is kept on the document, so linting, code actions and
+    fixes of an unchanged document only encode it once.
+
+    Parameters
+    ----------
+    document : pylsp.workspace.Document
+        Document to encode.
+
+    Returns
+    -------
+    The encoded source.
+
+    """
+    source = document.source
+    cached = document.shared_data.get(SOURCE_BYTES_KEY)
+    if cached is not None and cached[0] is source:
+        return cached[1]
+
+    encoded = source.encode()
+    document.shared_data[SOURCE_BYTES_KEY] = (source, encoded)
+    return encoded
+
+
+def source_digest(document: Document) -> bytes:
+    """Return a digest of the encoded source of the document.
+
+    Like the encoded source, the digest is kept on the document until the
+    source changes.
+
+    Parameters
+    ----------
+    document : pylsp.workspace.Document
+        Document to hash.
+
+    Returns
+    -------
+    The 16 byte blake2b digest.
+
+    """
+    source = document.source
+    cached = document.shared_data.get(SOURCE_DIGEST_KEY)
+    if cached is not None and cached[0] is source:
+        return cached[1]
+
+    digest = hashlib.blake2b(encode_source(document), digest_size=16).digest()
+    document.shared_data[SOURCE_DIGEST_KEY] = (source, digest)
+    return digest
 
 
 def run_ruff_fix(document: Document, settings: PluginSettings) -> str:
     result = run_ruff(
         document_path=document.path,
-        document_source=document.source,
+        document_source=encode_source(document),
         fix=True,
         settings=settings,
     )
-    return result
+    return result.decode()
 
 
 def run_ruff_format(
     settings: PluginSettings,
     document_path: str,
-    document_source: str,
+    document_source: Union[str, bytes],
 ) -> str:
     return run_ruff(
         settings=settings,
         document_path=document_path,
         document_source=document_source,
         subcommand=Subcommand.FORMAT,
-    )
+    ).decode()
 
 
 @lru_cache
@@ -502,7 +1083,7 @@ def find_executable(executable) -> List[str]:
     # try the python module
     if cmd is None:
         if importlib.util.find_spec("ruff") is not None:
-            cmd = [sys.executable, "-m", "ruff"]
+            cmd = find_ruff_module_executable()
 
     # try system's ruff executable
     if cmd is None:
@@ -519,14 +1100,34 @@ def find_executable(executable) -> List[str]:
     return cmd
 
 
+def find_ruff_module_executable() -> List[str]:
+    """Find the ruff binary shipped with the installed ruff python module.
+
+    `python -m ruff` only looks up the binary and `exec`s it, so every call pays
+    for a full interpreter startup. Calling the binary directly skips that step.
+
+    Returns
+    -------
+    List containing the command to invoke ruff.
+
+    """
+    try:
+        from ruff.__main__ import find_ruff_bin
+
+        return [os.fsdecode(find_ruff_bin())]
+    except (ImportError, FileNotFoundError):
+        log.debug("Could not locate the ruff binary, falling back to `-m ruff`.")
+        return [sys.executable, "-m", "ruff"]
+
+
 def run_ruff(
     settings: PluginSettings,
     document_path: str,
-    document_source: str,
+    document_source: Union[str, bytes],
     subcommand: Subcommand = Subcommand.CHECK,
     fix: bool = False,
     extra_arguments: Optional[List[str]] = None,
-) -> str:
+) -> bytes:
     """Run ruff on the given document and the given arguments.
 
     Parameters
@@ -535,8 +1136,8 @@ def run_ruff(
         Settings to use.
     document_path : str
         Path to file to run ruff on.
-    document_source : str
-        Document source or to apply ruff on.
+    document_source : Union[str, bytes]
+        Document source or to apply ruff on, optionally already utf-8 encoded.
         Needed when the source differs from the file source, e.g. during formatting.
     subcommand: Subcommand
         The ruff subcommand to run. Default = Subcommand.CHECK.
@@ -547,7 +1148,8 @@ def run_ruff(
 
     Returns
     -------
-    String containing the result in json format.
+    Bytes containing the output of ruff, i.e. the json formatted diagnostics or
+    the fixed/formatted source.
 
     """
     executable = settings.executable
@@ -557,13 +1159,62 @@ def run_ruff(
     cmd = [*find_executable(executable), str(subcommand), *arguments]
 
     log.debug(f"Calling {cmd} on '{document_path}'")
-    p = Popen(cmd, stdin=PIPE, stdout=PIPE)
-    (stdout, _) = p.communicate(document_source.encode())
+    if isinstance(document_source, bytes):
+        source = document_source
+    else:
+        source = document_source.encode()
+    global HAS_MEMFD
+    fd = None
+    if HAS_MEMFD:
+        try:
+            fd = create_source_file(source)
+        except OSError as e:
+            # The kernel or a sandbox may still refuse memfd_create, e.g. with
+            # ENOSYS or EPERM. Stick to the pipe from now on.
+            log.debug(f"Cannot create an in-memory file, using a pipe: {e}")
+            HAS_MEMFD = False
+    if fd is not None:
+        # Hand the source to ruff as an in-memory file instead of pushing it
+        # through a pipe in pipe-buffer sized chunks. With stdout being the only
+        # pipe, communicate() reads it until EOF without any select loop.
+        try:
+            p = Popen(cmd, stdin=fd, stdout=PIPE)
+            (stdout, _) = p.communicate()
+        finally:
+            os.close(fd)
+    else:
+        p = Popen(cmd, stdin=PIPE, stdout=PIPE)
+        (stdout, _) = p.communicate(source)
 
     if p.returncode != 0:
         log.error(f"Ruff returned {p.returncode} != 0")
 
-    return stdout.decode()
+    return stdout
+
+
+def create_source_file(source: bytes) -> int:
+    """Write the source to an anonymous in-memory file.
+
+    Parameters
+    ----------
+    source : bytes
+        The encoded document source.
+
+    Returns
+    -------
+    File descriptor of the file, positioned at its start.
+
+    """
+    fd = os.memfd_create("pylsp-ruff-source", os.MFD_CLOEXEC)
+    try:
+        view = memoryview(source)
+        while view:
+            view = view[os.write(fd, view) :]
+        os.lseek(fd, 0, os.SEEK_SET)
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
 
 
 def build_check_arguments(
@@ -609,48 +1260,40 @@ def build_check_arguments(
     if document_path != "":
         args.append(f"--stdin-filename={document_path}")
 
-    if settings.config:
-        args.append(f"--config={settings.config}")
-
-    if settings.line_length:
-        args.append(f"--line-length={settings.line_length}")
-
-    if settings.preview:
-        args.append("--preview")
+    args.extend(settings.check_arguments)
 
-    if settings.unsafe_fixes:
-        args.append("--unsafe-fixes")
+    for path, ignore_argument in settings.per_file_ignores_arguments:
+        if not match_path(document_path, path):
+            continue
+        args.append(ignore_argument)
 
-    if settings.exclude:
-        args.append(f"--exclude={','.join(settings.exclude)}")
-
-    if settings.select:
-        args.append(f"--select={','.join(settings.select)}")
+    if extra_arguments:
+        args.extend(extra_arguments)
 
-    if settings.extend_select:
-        args.append(f"--extend-select={','.join(settings.extend_select)}")
+    args.extend(["--", "-"])
 
-    if settings.ignore:
-        args.append(f"--ignore={','.join(settings.ignore)}")
+    return args
 
-    if settings.extend_ignore:
-        args.append(f"--extend-ignore={','.join(settings.extend_ignore)}")
 
-    if settings.target_version:
-        args.append(f"--target-version={settings.target_version}")
+@lru_cache(maxsize=256)
+def match_path(document_path: str, pattern: str) -> bool:
+    """Match a document path against a per-file-ignores pattern.
 
-    if settings.per_file_ignores:
-        for path, errors in settings.per_file_ignores.items():
-            if not PurePath(document_path).match(path):
-                continue
-            args.append(f"--ignore={','.join(errors)}")
+    `PurePath.match` translates the glob on every call, the result is memoized.
 
-    if extra_arguments:
-        args.extend(extra_arguments)
+    Parameters
+    ----------
+    document_path : str
+        Path of the document.
+    pattern : str
+        Glob pattern of the per-file-ignores setting.
 
-    args.extend(["--", "-"])
+    Returns
+    -------
+    True if the path matches the pattern.
 
-    return args
+    """
+    return PurePath(document_path).match(pattern)
 
 
 def build_format_arguments(
@@ -684,20 +1327,7 @@ def build_format_arguments(
     if document_path != "":
         args.append(f"--stdin-filename={document_path}")
 
-    if settings.config:
-        args.append(f"--config={settings.config}")
-
-    if settings.exclude:
-        args.append(f"--exclude={','.join(settings.exclude)}")
-
-    if settings.preview:
-        args.append("--preview")
-
-    if settings.line_length:
-        args.append(f"--line-length={settings.line_length}")
-
-    if settings.target_version:
-        args.append(f"--target-version={settings.target_version}")
+    args.extend(settings.format_arguments)
 
     if extra_arguments:
         args.extend(extra_arguments)
@@ -710,6 +1340,9 @@ def build_format_arguments(
 def load_settings(workspace: Workspace, document_path: str) -> PluginSettings:
     """Load settings from pyproject.toml file in the project path.
 
+    The resolved settings are cached and shared between calls, callers must not
+    modify the returned object.
+
     Parameters
     ----------
     workspace : pylsp.workspace.Workspace
@@ -724,28 +1357,117 @@ def load_settings(workspace: Workspace, document_path: str) -> PluginSettings:
     """
     config = workspace._config
     _plugin_settings = config.plugin_settings("ruff", document_path=document_path)
-    plugin_settings = converter.structure(_plugin_settings, PluginSettings)
 
-    pyproject_file = find_parents(
+    pyproject_file = find_parents_cached(
         workspace.root_path, document_path, ["pyproject.toml"]
     )
+    pyproject_path = pyproject_file[0] if pyproject_file else None
+
+    ruff_toml = find_parents_cached(
+        workspace.root_path, document_path, ["ruff.toml", ".ruff.toml"]
+    )
+
+    return _load_settings(
+        plugin_settings_key=json.dumps(_plugin_settings, sort_keys=True),
+        pyproject_path=pyproject_path,
+        pyproject_mtime=_get_mtime(pyproject_path),
+        has_ruff_toml=bool(ruff_toml),
+    )
+
+
+def find_parents_cached(root: str, path: str, names: List[str]) -> List[str]:
+    """Find files matching the given names relative to the given path.
+
+    Same as `pylsp._utils.find_parents`, but the result for a directory is reused
+    for `FIND_PARENTS_TTL` seconds to avoid walking the filesystem on every call.
+    At most `FIND_PARENTS_CACHE_SIZE` directories are kept.
+
+    Parameters
+    ----------
+    root : str
+        The directory at which to stop recursing upwards.
+    path : str
+        The file path to start searching up from.
+    names : List[str]
+        The file names to look for.
+
+    Returns
+    -------
+    List of the found files.
+
+    """
+    key = (root, os.path.dirname(path), tuple(names))
+    now = time.monotonic()
+    cached = _parent_cache.pop(key, None)
+    if cached is not None and now - cached[1] < FIND_PARENTS_TTL:
+        # Keep the entry, it is the most recently used one now
+        _parent_cache[key] = cached
+        return cached[0]
+
+    found = find_parents(root, path, names)
+    _parent_cache[key] = (found, now)
+    while len(_parent_cache) > FIND_PARENTS_CACHE_SIZE:
+        _parent_cache.popitem(last=False)
+    return found
+
+
+def _get_mtime(path: Optional[str]) -> Optional[int]:
+    if path is None:
+        return None
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+@lru_cache(maxsize=128)
+def _load_settings(
+    plugin_settings_key: str,
+    pyproject_path: Optional[str],
+    pyproject_mtime: Optional[int],
+    has_ruff_toml: bool,
+) -> PluginSettings:
+    """Resolve the plugin settings, cached on the pyproject.toml modification time.
+
+    Parameters
+    ----------
+    plugin_settings_key : str
+        Plugin settings given via lsp, serialized as json.
+    pyproject_path : Optional[str]
+        Path to the closest pyproject.toml, if any.
+    pyproject_mtime : Optional[int]
+        Modification time of the pyproject.toml in nanoseconds. Only used to
+        invalidate the cache.
+    has_ruff_toml : bool
+        Whether a ruff.toml or .ruff.toml was found.
+
+    Returns
+    -------
+    PluginSettings read via lsp.
+
+    """
+    plugin_settings = converter.structure(
+        json.loads(plugin_settings_key), PluginSettings
+    )
 
     config_in_pyproject = False
-    if pyproject_file:
+    if pyproject_path is not None and pyproject_mtime is not None:
+        # Only import the toml parser when there is something to parse
+        if sys.version_info >= (3, 11):
+            import tomllib
+        else:
+            import tomli as tomllib
+
         try:
-            with open(pyproject_file[0], "rb") as f:
+            with open(pyproject_path, "rb") as f:
                 toml_dict = tomllib.load(f)
                 if "tool" in toml_dict and "ruff" in toml_dict["tool"]:
                     config_in_pyproject = True
         except tomllib.TOMLDecodeError:
             log.warn("Error while parsing toml file, ignoring config.")
 
-    ruff_toml = find_parents(
-        workspace.root_path, document_path, ["ruff.toml", ".ruff.toml"]
-    )
-
     # Check if pyproject is present, ignore user settings if toml exists
-    if config_in_pyproject or ruff_toml:
+    if config_in_pyproject or has_ruff_toml:
         log.debug("Found existing configuration for ruff, skipping pylsp config.")
         # Leave config to pyproject.toml
         return PluginSettings(
@@ -753,6 +1475,7 @@ def load_settings(workspace: Workspace, document_path: str) -> PluginSettings:
             format_enabled=plugin_settings.format_enabled,
             executable=plugin_settings.executable,
             unsafe_fixes=plugin_settings.unsafe_fixes,
+            lazy_fix_all=plugin_settings.lazy_fix_all,
             extend_ignore=plugin_settings.extend_ignore,
             extend_select=plugin_settings.extend_select,
             format=plugin_settings.format,
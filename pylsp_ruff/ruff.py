@@ -1,28 +1,34 @@
+import sys
 from dataclasses import dataclass
 from typing import List, Optional
 
+# Slotted instances are smaller and faster to access, ruff can report thousands
+# of checks. `slots` is only supported from Python 3.10 on.
+DATACLASS_OPTIONS = {"slots": True} if sys.version_info >= (3, 10) else {}
 
-@dataclass
+
+# Frozen, so that equal locations can be shared between checks and edits
+@dataclass(frozen=True, **DATACLASS_OPTIONS)
 class Location:
     row: int
     column: int
 
 
-@dataclass
+@dataclass(**DATACLASS_OPTIONS)
 class Edit:
     content: str
     location: Location
     end_location: Location
 
 
-@dataclass
+@dataclass(**DATACLASS_OPTIONS)
 class Fix:
     edits: List[Edit]
     message: str
     applicability: str
 
 
-@dataclass
+@dataclass(**DATACLASS_OPTIONS)
 class Check:
     code: str
     message: str
@@ -1,5 +1,6 @@
 from dataclasses import dataclass, fields
-from typing import Dict, List, Optional
+from functools import cached_property
+from typing import Dict, List, Optional, Tuple
 
 import lsprotocol.converters
 from cattrs.gen import make_dict_structure_fn, make_dict_unstructure_fn, override
@@ -26,11 +27,82 @@ class PluginSettings:
 
     preview: bool = False
     unsafe_fixes: bool = False
+    lazy_fix_all: bool = False
 
     severities: Optional[Dict[str, str]] = None
 
     target_version: Optional[str] = None
 
+    # The argument properties are computed once per settings object, the settings
+    # must not be modified after they have been accessed.
+
+    @cached_property
+    def check_arguments(self) -> Tuple[str, ...]:
+        """Arguments to `ruff check` that only depend on the settings."""
+        args = []
+        if self.config:
+            args.append(f"--config={self.config}")
+
+        if self.line_length:
+            args.append(f"--line-length={self.line_length}")
+
+        if self.preview:
+            args.append("--preview")
+
+        if self.unsafe_fixes:
+            args.append("--unsafe-fixes")
+
+        if self.exclude:
+            args.append(f"--exclude={','.join(self.exclude)}")
+
+        if self.select:
+            args.append(f"--select={','.join(self.select)}")
+
+        if self.extend_select:
+            args.append(f"--extend-select={','.join(self.extend_select)}")
+
+        if self.ignore:
+            args.append(f"--ignore={','.join(self.ignore)}")
+
+        if self.extend_ignore:
+            args.append(f"--extend-ignore={','.join(self.extend_ignore)}")
+
+        if self.target_version:
+            args.append(f"--target-version={self.target_version}")
+
+        return tuple(args)
+
+    @cached_property
+    def format_arguments(self) -> Tuple[str, ...]:
+        """Arguments to `ruff format` that only depend on the settings."""
+        args = []
+        if self.config:
+            args.append(f"--config={self.config}")
+
+        if self.exclude:
+            args.append(f"--exclude={','.join(self.exclude)}")
+
+        if self.preview:
+            args.append("--preview")
+
+        if self.line_length:
+            args.append(f"--line-length={self.line_length}")
+
+        if self.target_version:
+            args.append(f"--target-version={self.target_version}")
+
+        return tuple(args)
+
+    @cached_property
+    def per_file_ignores_arguments(self) -> Tuple[Tuple[str, str], ...]:
+        """Pairs of path pattern and the `--ignore` argument to use for it."""
+        if not self.per_file_ignores:
+            return ()
+        return tuple(
+            (path, f"--ignore={','.join(errors)}")
+            for path, errors in self.per_file_ignores.items()
+        )
+
 
 def to_camel_case(snake_str: str) -> str:
     components = snake_str.split("_")
@@ -0,0 +1,104 @@
+# Copyright 2021- Python Language Server Contributors.
+
+import itertools
+import os
+from dataclasses import dataclass
+from typing import Any, List, Mapping, Optional
+from unittest.mock import Mock
+
+import pytest
+from pylsp import uris
+from pylsp.config.config import Config
+from pylsp.workspace import Document, Workspace
+
+import pylsp_ruff.plugin as plugin
+
+_document_ids = itertools.count()
+
+
+@pytest.fixture(scope="module")
+def workspace(tmp_path_factory):
+    """Return a workspace shared by the tests of this module."""
+    root = tmp_path_factory.mktemp("workspace")
+    ws = Workspace(root.absolute().as_uri(), Mock())
+    ws._config = Config(ws.root_uri, {}, 0, {})
+    return ws
+
+
+@pytest.fixture(autouse=True)
+def reset_workspace(workspace):
+    """Reset the settings of the shared workspace after each test."""
+    yield
+    workspace._config.update({})
+    # Config files written by a test must not be hidden by cached lookups
+    plugin._parent_cache.clear()
+
+
+@pytest.fixture()
+def temp_document(workspace):
+    """Return a function creating a document with the given source."""
+
+    def create(doc_text):
+        # Keep the document in memory, the plugin passes the source through stdin
+        name = os.path.join(workspace.root_path, f"t_{next(_document_ids)}.py")
+        doc_uri = uris.from_fs_path(name)
+        workspace.put_document(doc_uri, doc_text)
+        return name, workspace.get_document(doc_uri)
+
+    return create
+
+
+@pytest.fixture(scope="module")
+def pyproject(workspace):
+    """Return a function writing a ``pyproject.toml`` into the workspace.
+
+    Every distinct config is written once per module into its own directory,
+    the function returns the path of that directory.
+    """
+    directories = {}
+
+    def create(config_str):
+        if config_str not in directories:
+            directory = os.path.join(workspace.root_path, f"project_{len(directories)}")
+            os.mkdir(directory)
+            with open(
+                os.path.join(directory, "pyproject.toml"), "w", encoding="utf-8"
+            ) as f:
+                f.write(config_str)
+            directories[config_str] = directory
+        return directories[config_str]
+
+    return create
+
+
+@dataclass
+class _FormatResult:
+    """Stands in for the pluggy result of the `pylsp_format_document` wrapper."""
+
+    result: Optional[List[Mapping[str, Any]]] = None
+
+    def get_result(self):
+        return self.result
+
+    def force_result(self, r):
+        self.result = r
+
+
+@pytest.fixture()
+def run_plugin_format(workspace):
+    """Return a function running the format hook on a document."""
+
+    def run(doc: Document) -> str:
+        generator = plugin.pylsp_format_document(workspace, doc)
+        result = _FormatResult()
+        next(generator)
+        try:
+            generator.send(result)
+        except StopIteration:
+            pass
+
+        if result.result:
+            return result.result[0]["newText"]
+        return ""
+
+    return run
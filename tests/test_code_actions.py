@@ -1,31 +1,19 @@
 # Copyright 2017-2020 Palantir Technologies, Inc.
 # Copyright 2021- Python Language Server Contributors.
 
-import tempfile
 from textwrap import dedent
-from typing import List
-from unittest.mock import Mock
+from unittest.mock import patch
 
-import cattrs
 import pytest
-from lsprotocol.converters import get_converter
-from lsprotocol.types import CodeAction, Position, Range
-from pylsp import uris
-from pylsp.config.config import Config
-from pylsp.workspace import Document, Workspace
+from pylsp.workspace import Document
 
 import pylsp_ruff.plugin as ruff_lint
 
-converter = get_converter()
-
-
-@pytest.fixture()
-def workspace(tmp_path):
-    """Return a workspace."""
-    ws = Workspace(tmp_path.absolute().as_uri(), Mock())
-    ws._config = Config(ws.root_uri, {}, 0, {})
-    return ws
-
+# The range of the code action requests, not used by the plugin
+_ZERO_RANGE = {
+    "start": {"line": 0, "character": 0},
+    "end": {"line": 0, "character": 0},
+}
 
 codeaction_str = dedent(
     """
@@ -42,6 +30,33 @@ import_str = dedent(
     """
 )
 
+noqa_str = dedent(
+    """
+    import os  # NoQA: E501
+    import re, sys
+    """
+)
+
+fix_all_str = dedent(
+    """
+    def f():
+        pass
+    """
+)
+
+fix_all_safe_str = dedent(
+    """
+    def f():
+        a = 2
+    """
+)
+
+noqa_expected = [
+    "import os  # NoQA: E501,F401",
+    "import re, sys  # noqa: F401",
+    "import re, sys  # noqa: F401",
+]
+
 codeactions = [
     "Ruff (F401): Remove unused import: `os`",
     "Ruff (F401): Disable for this line",
@@ -57,35 +72,157 @@ codeactions_import = [
 ]
 
 
-def temp_document(doc_text, workspace):
-    with tempfile.NamedTemporaryFile(
-        mode="w", dir=workspace.root_path, delete=False
-    ) as temp_file:
-        name = temp_file.name
-        temp_file.write(doc_text)
-    doc = Document(uris.from_fs_path(name), workspace)
-    return name, doc
+def test_ruff_code_actions(workspace, temp_document):
+    _, doc = temp_document(codeaction_str)
+
+    workspace._config.update(
+        {"plugins": {"ruff": {"select": ["F"], "unsafeFixes": True}}}
+    )
+    diags = ruff_lint.pylsp_lint(workspace, doc)
+    actions = ruff_lint.pylsp_code_actions(
+        workspace._config,
+        workspace,
+        doc,
+        range=_ZERO_RANGE,
+        context={"diagnostics": diags},
+    )
+    action_titles = [action["title"] for action in actions]
+    assert sorted(codeactions) == sorted(action_titles)
 
 
-def test_ruff_code_actions(workspace):
-    _, doc = temp_document(codeaction_str, workspace)
+def test_code_actions_reuse_lint(workspace, temp_document):
+    _, doc = temp_document(codeaction_str)
+
+    workspace._config.update({"plugins": {"ruff": {"select": ["F"]}}})
+    diags = ruff_lint.pylsp_lint(workspace, doc)
+    with patch("pylsp_ruff.plugin.run_ruff_check") as run_ruff_check_mock:
+        actions = ruff_lint.pylsp_code_actions(
+            workspace._config,
+            workspace,
+            doc,
+            range=_ZERO_RANGE,
+            context={"diagnostics": diags},
+        )
+    run_ruff_check_mock.assert_not_called()
+    assert "Ruff: Fix All (safe fixes)" in [action["title"] for action in actions]
+
+
+def test_code_actions_concurrent_check(workspace, temp_document):
+    _, doc = temp_document(codeaction_str)
 
     workspace._config.update(
         {"plugins": {"ruff": {"select": ["F"], "unsafeFixes": True}}}
     )
     diags = ruff_lint.pylsp_lint(workspace, doc)
-    range_ = cattrs.unstructure(
-        Range(start=Position(line=0, character=0), end=Position(line=0, character=0))
+    # Run ruff in the background even though the lint result is cached
+    with patch("pylsp_ruff.plugin.CONCURRENT_CHECK_MIN_DIAGNOSTICS", 0), patch(
+        "pylsp_ruff.plugin.get_cached_checks", return_value=None
+    ):
+        actions = ruff_lint.pylsp_code_actions(
+            workspace._config,
+            workspace,
+            doc,
+            range=_ZERO_RANGE,
+            context={"diagnostics": diags},
+        )
+    assert sorted(codeactions) == sorted(action["title"] for action in actions)
+
+
+def test_disable_code_action(workspace, temp_document):
+    _, doc = temp_document(noqa_str)
+
+    workspace._config.update({"plugins": {"ruff": {"select": ["F"]}}})
+    diags = ruff_lint.pylsp_lint(workspace, doc)
+    actions = ruff_lint.pylsp_code_actions(
+        workspace._config,
+        workspace,
+        doc,
+        range=_ZERO_RANGE,
+        context={"diagnostics": diags},
     )
+    new_lines = [
+        edit["newText"]
+        for action in actions
+        if action["title"].endswith("Disable for this line")
+        for edit in action["edit"]["changes"][doc.uri]
+    ]
+    assert sorted(new_lines) == sorted(noqa_expected)
+
+
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        (
+            "x = 1\rimport os\rimport sys\r",
+            [(1, "import os  # noqa: F401"), (2, "import sys  # noqa: F401")],
+        ),
+        ("x = 1\ry = 2\nimport os\nz = 3\n", [(2, "import os  # noqa: F401")]),
+    ],
+)
+def test_disable_code_action_lone_cr(workspace, temp_document, source, expected):
+    # ruff and LSP count a lone `\r` as line break as well
+    _, doc = temp_document(source)
+
+    workspace._config.update({"plugins": {"ruff": {"select": ["F"]}}})
+    diags = ruff_lint.pylsp_lint(workspace, doc)
     actions = ruff_lint.pylsp_code_actions(
-        workspace._config, workspace, doc, range=range_, context={"diagnostics": diags}
+        workspace._config,
+        workspace,
+        doc,
+        range=_ZERO_RANGE,
+        context={"diagnostics": diags},
     )
-    actions = converter.structure(actions, List[CodeAction])
-    action_titles = list(map(lambda action: action.title, actions))
-    assert sorted(codeactions) == sorted(action_titles)
+    edits = [
+        (edit["range"]["start"]["line"], edit["newText"])
+        for action in actions
+        if action["title"].endswith("Disable for this line")
+        for edit in action["edit"]["changes"][doc.uri]
+    ]
+    assert sorted(edits) == expected
 
 
-def test_import_action(workspace):
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        ("a\nb\nc\n", ["a\n", "b\n", "c\n"]),
+        ("a\r\nb\r\nc", ["a\r\n", "b\r\n", "c"]),
+        ("a\rb\rc\r", ["a\r", "b\r", "c\r"]),
+        ("a\rb\nc\r\nd", ["a\r", "b\n", "c\r\n", "d"]),
+    ],
+)
+def test_get_line(workspace, source, expected):
+    doc = Document("", workspace, source)
+    assert [ruff_lint.get_line(doc, i) for i in range(len(expected))] == expected
+
+
+@pytest.mark.parametrize(
+    "line, expected",
+    [
+        ("import os", (False, False)),
+        ("import os  # comment", (False, False)),
+        ("import os  # noqa", (True, False)),
+        ("import os  # NoQA: F401", (True, True)),
+        ("import os  # noqa:F401,E501", (True, True)),
+        ("import os  # noqa: f401", (True, False)),
+        ("import os  # ruff: noqa: F401", (True, True)),
+        ("import os  # flake8: noqa", (True, False)),
+        ("import os  #noqa: F401", (False, False)),
+        ("import os  # noqa # noqa: F401", (True, False)),
+    ],
+)
+def test_find_noqa(line, expected):
+    assert ruff_lint.find_noqa(line) == expected
+
+
+@pytest.mark.parametrize(
+    "source", ["", "a", "a\n", "a\nb", "a\r\nb\r\n", "x\r", "a\rb\r", "a\rb\nc"]
+)
+def test_get_line_count(workspace, source):
+    doc = Document("", workspace, source)
+    assert ruff_lint.get_line_count(doc) == len(doc.lines)
+
+
+def test_import_action(workspace, temp_document):
     workspace._config.update(
         {
             "plugins": {
@@ -96,57 +233,143 @@ def test_import_action(workspace):
             }
         }
     )
-    _, doc = temp_document(import_str, workspace)
+    _, doc = temp_document(import_str)
 
     diags = ruff_lint.pylsp_lint(workspace, doc)
-    range_ = cattrs.unstructure(
-        Range(start=Position(line=0, character=0), end=Position(line=0, character=0))
-    )
     actions = ruff_lint.pylsp_code_actions(
-        workspace._config, workspace, doc, range=range_, context={"diagnostics": diags}
+        workspace._config,
+        workspace,
+        doc,
+        range=_ZERO_RANGE,
+        context={"diagnostics": diags},
     )
-    actions = converter.structure(actions, List[CodeAction])
-    action_titles = list(map(lambda action: action.title, actions))
+    action_titles = [action["title"] for action in actions]
     assert sorted(codeactions_import) == sorted(action_titles)
 
 
-def test_fix_all(workspace):
-    expected_str = dedent(
-        """
-        def f():
-            pass
-        """
-    )
-    expected_str_safe = dedent(
-        """
-        def f():
-            a = 2
-        """
+def test_import_action_skips_check(workspace, temp_document):
+    workspace._config.update(
+        {
+            "plugins": {
+                "ruff": {
+                    "extendSelect": ["I"],
+                    "extendIgnore": ["F"],
+                }
+            }
+        }
     )
+    _, doc = temp_document(import_str)
+
+    diags = ruff_lint.pylsp_lint(workspace, doc)
+    # The I001 diagnostic provides both the organize imports and Fix All actions
+    with patch("pylsp_ruff.plugin.get_cached_checks", return_value=None), patch(
+        "pylsp_ruff.plugin.run_ruff_check"
+    ) as run_ruff_check_mock:
+        actions = ruff_lint.pylsp_code_actions(
+            workspace._config,
+            workspace,
+            doc,
+            range=_ZERO_RANGE,
+            context={"diagnostics": diags},
+        )
+    run_ruff_check_mock.assert_not_called()
+    assert sorted(codeactions_import) == sorted(action["title"] for action in actions)
+
+
+@pytest.mark.parametrize(
+    "only,expected",
+    [
+        (["quickfix"], ["Ruff (I001): Disable for this line"]),
+        (["source.organizeImports"], ["Ruff: Organize imports"]),
+        (["source"], ["Ruff: Organize imports", "Ruff: Fix All (safe fixes)"]),
+        (["refactor"], []),
+    ],
+)
+def test_code_actions_only(workspace, temp_document, only, expected):
     workspace._config.update(
         {
             "plugins": {
                 "ruff": {
-                    "unsafeFixes": True,
+                    "extendSelect": ["I"],
+                    "extendIgnore": ["F"],
                 }
             }
         }
     )
-    _, doc = temp_document(codeaction_str, workspace)
-    settings = ruff_lint.load_settings(workspace, doc.path)
-    fixed_str = ruff_lint.run_ruff_fix(doc, settings)
-    assert fixed_str == expected_str
+    _, doc = temp_document(import_str)
 
+    diags = ruff_lint.pylsp_lint(workspace, doc)
+    actions = ruff_lint.pylsp_code_actions(
+        workspace._config,
+        workspace,
+        doc,
+        range=_ZERO_RANGE,
+        context={"diagnostics": diags, "only": only},
+    )
+    assert sorted(expected) == sorted(action["title"] for action in actions)
+
+
+@pytest.mark.parametrize(
+    "unsafe_fixes,expected",
+    [(True, fix_all_str), (False, fix_all_safe_str)],
+)
+def test_fix_all(workspace, temp_document, unsafe_fixes, expected):
     workspace._config.update(
         {
             "plugins": {
                 "ruff": {
-                    "unsafeFixes": False,
+                    "unsafeFixes": unsafe_fixes,
                 }
             }
         }
     )
-    _, doc = temp_document(codeaction_str, workspace)
+    _, doc = temp_document(codeaction_str)
     settings = ruff_lint.load_settings(workspace, doc.path)
     fixed_str = ruff_lint.run_ruff_fix(doc, settings)
-    assert fixed_str == expected_str_safe
+    assert fixed_str == expected
+
+
+@pytest.mark.parametrize("lazy_fix_all", [False, True])
+def test_fix_all_code_action(workspace, temp_document, lazy_fix_all):
+    _, doc = temp_document(codeaction_str)
+    doc.version = 1
+
+    workspace._config.update(
+        {"plugins": {"ruff": {"select": ["F"], "lazyFixAll": lazy_fix_all}}}
+    )
+    actions = ruff_lint.pylsp_code_actions(
+        workspace._config,
+        workspace,
+        doc,
+        range=_ZERO_RANGE,
+        context={"diagnostics": [], "only": ["source.fixAll"]},
+    )
+    (action,) = actions
+    if lazy_fix_all:
+        assert "edit" not in action
+        assert action["command"]["command"] == ruff_lint.FIX_ALL_COMMAND
+        assert action["command"]["arguments"] == [doc.uri, 1]
+    else:
+        assert "command" not in action
+        (text_edit,) = action["edit"]["changes"][doc.uri]
+        assert text_edit["newText"] == fix_all_safe_str
+
+
+@pytest.mark.parametrize(
+    "document_version,applied",
+    [(1, True), (2, False), (None, False)],
+)
+def test_fix_all_command(workspace, temp_document, document_version, applied):
+    _, doc = temp_document(codeaction_str)
+    doc.version = document_version
+
+    with patch.object(workspace, "apply_edit") as apply_edit_mock:
+        ruff_lint.pylsp_execute_command(
+            workspace, ruff_lint.FIX_ALL_COMMAND, [doc.uri, 1]
+        )
+    if not applied:
+        apply_edit_mock.assert_not_called()
+        return
+    ((workspace_edit,), _) = apply_edit_mock.call_args
+    (text_edit,) = workspace_edit["changes"][doc.uri]
+    assert text_edit["newText"] == fix_all_safe_str
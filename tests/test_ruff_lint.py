@@ -1,20 +1,27 @@
 # Copyright 2017-2020 Palantir Technologies, Inc.
 # Copyright 2021- Python Language Server Contributors.
 
+import errno
 import os
 import stat
-import sys
 import tempfile
-from unittest.mock import Mock, patch
+from unittest.mock import patch
 
-import pytest
+from lsprotocol.types import Diagnostic, DiagnosticSeverity, Position, Range
 from pylsp import lsp, uris
-from pylsp.config.config import Config
-from pylsp.workspace import Document, Workspace
+from pylsp.workspace import Document
+from ruff.__main__ import find_ruff_bin
 
 import pylsp_ruff.plugin as ruff_lint
+from pylsp_ruff.ruff import Check as RuffCheck
+from pylsp_ruff.ruff import Edit as RuffEdit
+from pylsp_ruff.ruff import Fix as RuffFix
+from pylsp_ruff.ruff import Location as RuffLocation
+from pylsp_ruff.settings import PluginSettings
 
 DOC_URI = uris.from_fs_path(__file__)
+# The plugin resolves the binary once as well, see `find_executable`
+RUFF_BIN = os.fsdecode(find_ruff_bin())
 DOC = r"""import pylsp
 
 t = "TEST"
@@ -25,27 +32,8 @@ def using_const():
 """
 
 
-@pytest.fixture()
-def workspace(tmp_path):
-    """Return a workspace."""
-    ws = Workspace(tmp_path.absolute().as_uri(), Mock())
-    ws._config = Config(ws.root_uri, {}, 0, {})
-    return ws
-
-
-def temp_document(doc_text, workspace):
-    with tempfile.NamedTemporaryFile(
-        mode="w", dir=workspace.root_path, delete=False
-    ) as temp_file:
-        name = temp_file.name
-        temp_file.write(doc_text)
-    doc = Document(uris.from_fs_path(name), workspace)
-    return name, doc
-
-
-def test_ruff_unsaved(workspace):
-    doc = Document("", workspace, DOC)
-    diags = ruff_lint.pylsp_lint(workspace, doc)
+def assert_unused_var(diags):
+    """Check the diagnostic of the unused variable in ``DOC``."""
     msg = "Local variable `a` is assigned to but never used"
     unused_var = [d for d in diags if d["message"] == msg][0]
 
@@ -57,28 +45,148 @@ def test_ruff_unsaved(workspace):
     assert unused_var["tags"] == [lsp.DiagnosticTag.Unnecessary]
 
 
-def test_ruff_lint(workspace):
-    name, doc = temp_document(DOC, workspace)
-    try:
+def test_ruff_unsaved(workspace):
+    doc = Document("", workspace, DOC)
+    diags = ruff_lint.pylsp_lint(workspace, doc)
+    assert_unused_var(diags)
+
+
+def test_ruff_lint(workspace, temp_document):
+    _name, doc = temp_document(DOC)
+    diags = ruff_lint.pylsp_lint(workspace, doc)
+    assert_unused_var(diags)
+
+
+def test_ruff_lint_pipe(workspace, temp_document):
+    # Pass the source through a pipe on platforms without memfd_create
+    _name, doc = temp_document(DOC)
+    with patch("pylsp_ruff.plugin.HAS_MEMFD", False):
         diags = ruff_lint.pylsp_lint(workspace, doc)
-        msg = "Local variable `a` is assigned to but never used"
-        unused_var = [d for d in diags if d["message"] == msg][0]
+    assert "F841" in [d["code"] for d in diags]
+
+
+def test_ruff_lint_memfd_unavailable(workspace, temp_document):
+    # Fall back to the pipe if memfd_create exists but fails at runtime
+    _name, doc = temp_document(DOC)
+    error = OSError(errno.ENOSYS, "Function not implemented")
+    with patch("pylsp_ruff.plugin.HAS_MEMFD", True), patch(
+        "pylsp_ruff.plugin.os.memfd_create", create=True, side_effect=error
+    ) as memfd_create_mock:
+        diags = ruff_lint.pylsp_lint(workspace, doc)
+        # Later calls go straight to the pipe
+        assert ruff_lint.pylsp_lint(workspace, doc) == diags
+    assert "F841" in [d["code"] for d in diags]
+    memfd_create_mock.assert_called_once()
+
+
+def test_ruff_syntax_error(workspace, temp_document):
+    _name, doc = temp_document("x = (\n")
+    diags = ruff_lint.pylsp_lint(workspace, doc)
+    assert diags
+    assert all(d["severity"] == lsp.DiagnosticSeverity.Error for d in diags)
+
+
+UNUSED_VARIABLE_FIX = RuffFix(
+    edits=[
+        RuffEdit(
+            content="",
+            location=RuffLocation(row=6, column=5),
+            end_location=RuffLocation(row=6, column=9),
+        )
+    ],
+    message="Remove assignment to unused variable `a`",
+    applicability="unsafe",
+)
+CHECKS = [
+    RuffCheck(
+        code="F841",
+        message="Local variable `a` is assigned to but never used",
+        filename="test.py",
+        location=RuffLocation(row=6, column=5),
+        end_location=RuffLocation(row=6, column=6),
+        fix=UNUSED_VARIABLE_FIX,
+    ),
+    RuffCheck(
+        code="W291",
+        message="Trailing whitespace",
+        filename="test.py",
+        location=RuffLocation(row=1, column=13),
+        end_location=RuffLocation(row=1, column=14),
+    ),
+]
+
+
+def test_create_diagnostic_dicts():
+    diagnostics = ruff_lint.create_diagnostic_dicts(
+        checks=CHECKS, settings=PluginSettings()
+    )
+    assert diagnostics == [
+        {
+            "range": {
+                "start": {"line": 5, "character": 4},
+                "end": {"line": 5, "character": 5},
+            },
+            "message": "Local variable `a` is assigned to but never used",
+            "severity": 1,
+            "code": "F841",
+            "source": "ruff",
+            "tags": [1],
+            "data": {
+                "edits": [
+                    {
+                        "content": "",
+                        "location": {"row": 6, "column": 5},
+                        "end_location": {"row": 6, "column": 9},
+                    }
+                ],
+                "message": "Remove assignment to unused variable `a`",
+                "applicability": "unsafe",
+            },
+        },
+        {
+            "range": {
+                "start": {"line": 0, "character": 12},
+                "end": {"line": 0, "character": 13},
+            },
+            "message": "Trailing whitespace",
+            "severity": 2,
+            "code": "W291",
+            "source": "ruff",
+            "tags": [],
+        },
+    ]
+
+
+def test_create_diagnostic():
+    diagnostic = ruff_lint.create_diagnostic(check=CHECKS[1], settings=PluginSettings())
+    # Compare the wire format, cattrs structures the tags as a tuple
+    expected = Diagnostic(
+        range=Range(
+            start=Position(line=0, character=12),
+            end=Position(line=0, character=13),
+        ),
+        message="Trailing whitespace",
+        severity=DiagnosticSeverity.Warning,
+        code="W291",
+        source="ruff",
+        tags=[],
+    )
+    unstructure = ruff_lint.converter.unstructure
+    assert unstructure(diagnostic) == unstructure(expected)
 
-        assert unused_var["source"] == "ruff"
-        assert unused_var["code"] == "F841"
-        assert unused_var["range"]["start"] == {"line": 5, "character": 4}
-        assert unused_var["range"]["end"] == {"line": 5, "character": 5}
-        assert unused_var["severity"] == lsp.DiagnosticSeverity.Error
-        assert unused_var["tags"] == [lsp.DiagnosticTag.Unnecessary]
-    finally:
-        os.remove(name)
 
+def test_create_diagnostic_keeps_fix():
+    # The code actions take the fix from the data without structuring it again
+    diagnostic = ruff_lint.create_diagnostic(check=CHECKS[0], settings=PluginSettings())
+    assert diagnostic.data is UNUSED_VARIABLE_FIX
+    assert ruff_lint.get_diagnostic_fix(diagnostic) is UNUSED_VARIABLE_FIX
 
-def test_ruff_config_param(workspace):
+
+def test_ruff_config_param(workspace, temp_document, tmp_path):
     with patch("pylsp_ruff.plugin.Popen") as popen_mock:
         mock_instance = popen_mock.return_value
         mock_instance.communicate.return_value = [bytes(), bytes()]
-        ruff_conf = "/tmp/pyproject.toml"
+        ruff_conf = str(tmp_path / "pyproject.toml")
         workspace._config.update(
             {
                 "plugins": {
@@ -90,16 +198,16 @@ def test_ruff_config_param(workspace):
                 }
             }
         )
-        _name, doc = temp_document(DOC, workspace)
+        _name, doc = temp_document(DOC)
         ruff_lint.pylsp_lint(workspace, doc)
         (call_args,) = popen_mock.call_args[0]
-        assert "ruff" in call_args
+        assert RUFF_BIN in call_args
         assert f"--config={ruff_conf}" in call_args
         assert "--extend-select=D,F" in call_args
         assert "--extend-ignore=E" in call_args
 
 
-def test_ruff_executable_param(workspace):
+def test_ruff_executable_param(workspace, temp_document):
     with patch("pylsp_ruff.plugin.Popen") as popen_mock:
         with tempfile.NamedTemporaryFile() as ruff_exe:
             mock_instance = popen_mock.return_value
@@ -114,30 +222,14 @@ def test_ruff_executable_param(workspace):
                 {"plugins": {"ruff": {"executable": ruff_executable}}}
             )
 
-            _name, doc = temp_document(DOC, workspace)
+            _name, doc = temp_document(DOC)
             ruff_lint.pylsp_lint(workspace, doc)
 
             (call_args,) = popen_mock.call_args[0]
             assert ruff_executable in call_args
 
 
-def get_ruff_settings(workspace, doc, config_str):
-    """Write a ``pyproject.toml``, load it in the workspace, and return the ruff
-    settings.
-
-    This function creates a ``pyproject.toml``; you'll have to delete it yourself.
-    """
-
-    with open(
-        os.path.join(workspace.root_path, "pyproject.toml"), "w+", encoding="utf-8"
-    ) as f:
-        f.write(config_str)
-
-    return ruff_lint.load_settings(workspace, doc.path)
-
-
-def test_ruff_settings(workspace):
-    config_str = r"""[tool.ruff]
+SETTINGS_CONFIG = r"""[tool.ruff]
 ignore = ["F841"]
 exclude = [
     "blah/__init__.py",
@@ -148,19 +240,26 @@ extend-select = ["D"]
 "test_something.py" = ["F401"]
 """
 
-    doc_str = r"""
+SETTINGS_DOC = r"""
 print('hi')
 import os
 def f():
     a = 2
 """
 
-    doc_uri = uris.from_fs_path(os.path.join(workspace.root_path, "__init__.py"))
-    workspace.put_document(doc_uri, doc_str)
 
-    ruff_settings = get_ruff_settings(
-        workspace, workspace.get_document(doc_uri), config_str
-    )
+def settings_document(workspace, project, path):
+    """Put ``SETTINGS_DOC`` at the given path of the project and return it."""
+    doc_uri = uris.from_fs_path(os.path.join(project, path))
+    workspace.put_document(doc_uri, SETTINGS_DOC)
+    return workspace.get_document(doc_uri)
+
+
+def test_ruff_settings(workspace, pyproject):
+    project = pyproject(SETTINGS_CONFIG)
+    doc = settings_document(workspace, project, "__init__.py")
+
+    ruff_settings = ruff_lint.load_settings(workspace, doc.path)
 
     # Check that user config is ignored
     empty_keys = [
@@ -178,14 +277,11 @@ def f():
         mock_instance = popen_mock.return_value
         mock_instance.communicate.return_value = [bytes(), bytes()]
 
-        doc = workspace.get_document(doc_uri)
-        diags = ruff_lint.pylsp_lint(workspace, doc)
+        ruff_lint.pylsp_lint(workspace, doc)
 
     call_args = popen_mock.call_args[0][0]
     assert call_args == [
-        str(sys.executable),
-        "-m",
-        "ruff",
+        RUFF_BIN,
         "check",
         "--quiet",
         "--exit-zero",
@@ -193,11 +289,13 @@ def f():
         "--extension=ipynb:python",
         "--no-fix",
         "--force-exclude",
-        f"--stdin-filename={os.path.join(workspace.root_path, '__init__.py')}",
+        f"--stdin-filename={os.path.join(project, '__init__.py')}",
         "--",
         "-",
     ]
 
+
+def test_ruff_settings_severities(workspace, pyproject):
     workspace._config.update(
         {
             "plugins": {
@@ -208,6 +306,8 @@ def f():
             }
         }
     )
+    project = pyproject(SETTINGS_CONFIG)
+    doc = settings_document(workspace, project, "__init__.py")
 
     diags = ruff_lint.pylsp_lint(workspace, doc)
 
@@ -227,31 +327,61 @@ def f():
         if diag["code"] == "D103":
             assert diag["severity"] == 4  # Should take "D1" over "D"
 
-    # Excludes
-    doc_uri = uris.from_fs_path(os.path.join(workspace.root_path, "blah/__init__.py"))
-    workspace.put_document(doc_uri, doc_str)
 
-    ruff_settings = get_ruff_settings(
-        workspace, workspace.get_document(doc_uri), config_str
-    )
+def test_ruff_settings_excludes(workspace, pyproject):
+    project = pyproject(SETTINGS_CONFIG)
 
-    doc = workspace.get_document(doc_uri)
+    # Excludes
+    doc = settings_document(workspace, project, "blah/__init__.py")
     diags = ruff_lint.pylsp_lint(workspace, doc)
     assert diags == []
 
     # For per-file-ignores
-    doc_uri_per_file_ignores = uris.from_fs_path(
-        os.path.join(workspace.root_path, "blah/test_something.py")
-    )
-    workspace.put_document(doc_uri_per_file_ignores, doc_str)
-
-    doc = workspace.get_document(doc_uri)
+    doc = settings_document(workspace, project, "blah/test_something.py")
     diags = ruff_lint.pylsp_lint(workspace, doc)
 
+    assert diags
     for diag in diags:
         assert diag["code"] != "F401"
 
-    os.unlink(os.path.join(workspace.root_path, "pyproject.toml"))
+
+def test_ruff_settings_cache(workspace):
+    workspace._config.update({"plugins": {"ruff": {"select": ["F"]}}})
+    # The test modifies its pyproject.toml, do not share it via the fixture
+    project = os.path.join(workspace.root_path, "settings_cache")
+    os.mkdir(project)
+    pyproject = os.path.join(project, "pyproject.toml")
+    with open(pyproject, "w", encoding="utf-8") as f:
+        f.write("[project]\n")
+    doc_uri = uris.from_fs_path(os.path.join(project, "__init__.py"))
+    workspace.put_document(doc_uri, "")
+    doc = workspace.get_document(doc_uri)
+
+    ruff_settings = ruff_lint.load_settings(workspace, doc.path)
+    assert ruff_settings.select == ["F"]
+    assert ruff_lint.load_settings(workspace, doc.path) is ruff_settings
+
+    # Changing the pyproject.toml invalidates the cached settings
+    with open(pyproject, "w", encoding="utf-8") as f:
+        f.write("[tool.ruff]\n")
+    mtime = os.stat(pyproject).st_mtime_ns + 1_000_000_000
+    os.utime(pyproject, ns=(mtime, mtime))
+    ruff_settings = ruff_lint.load_settings(workspace, doc.path)
+    assert ruff_settings.select is None
+
+
+def test_find_parents_cache_size(workspace):
+    root = workspace.root_path
+    names = ["pyproject.toml"]
+    with patch("pylsp_ruff.plugin.FIND_PARENTS_CACHE_SIZE", 2):
+        for directory in ("a", "b", "a", "c"):
+            path = os.path.join(root, directory, "test.py")
+            ruff_lint.find_parents_cached(root, path, names)
+    # The least recently used directory is dropped first
+    assert [key[1] for key in ruff_lint._parent_cache] == [
+        os.path.join(root, "a"),
+        os.path.join(root, "c"),
+    ]
 
 
 def test_notebook_input(workspace):